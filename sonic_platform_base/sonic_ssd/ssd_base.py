@@ -9,6 +9,8 @@ class SsdBase(object):
     """
     Base class for interfacing with a SSD
     """
+    __slots__ = ()
+
     def __init__(self, diskdev):
         """
         Constructor
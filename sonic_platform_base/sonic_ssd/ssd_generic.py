@@ -8,93 +8,332 @@
 #  - Virtium
 
 try:
-    import re
+    import os
     import subprocess
+    import threading
     from .ssd_base import SsdBase
 except ImportError as e:
     raise ImportError (str(e) + "- required module not found")
 
-SMARTCTL = "smartctl {} -a"
-INNODISK = "iSmart -d {}"
-VIRTIUM  = "SmartCmd -m {}"
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+# Command line of each utility; the disk device is appended as the last argument.
+# smartctl is limited to the identity (-i) section: model, serial and firmware
+# are all the generic parser reads, and skipping the other sections avoids
+# their slow ioctls. Vendor specific tables are reported by iSmart/SmartCmd.
+SMARTCTL = ("smartctl", "-i")
+INNODISK = ("iSmart", "-d")
+VIRTIUM  = ("SmartCmd", "-m")
+
+# Utility and parser method of each disk vendor, keyed on the first word of
+# the disk model. smartctl is run for every disk by fetch_generic_ssd_info.
+_VENDORS = {
+    "InnoDisk" : (INNODISK, "_parse_innodisk"),
+    "M.2"      : (INNODISK, "_parse_innodisk"),
+    "StorFly"  : (VIRTIUM,  "_parse_virtium"),
+    "Virtium"  : (VIRTIUM,  "_parse_virtium")
+}
 
 NOT_AVAILABLE = "N/A"
 
+# Parsed disk information is shared between SsdUtil instances of the same disk
+# for SSD_CACHE_TTL seconds, so callers creating an instance on every poll do
+# not run the utilities again each time. Each loading stage is cached with its
+# own timestamp: diskdev -> {'generic' or 'vendor': (timestamp, values)}.
+SSD_CACHE_TTL = 60
+_SSD_CACHE = {}
+
+# One lock per disk, shared by all instances for it, so that instances loading
+# the same disk at the same time run the utilities once and the rest are served
+# from _SSD_CACHE
+_SSD_LOCKS = {}
+_SSD_LOCKS_GUARD = threading.Lock()
+
+# Attributes filled in by each loading stage. They stay unset until first
+# accessed, at which point SsdUtil.__getattr__ runs the stage that provides them.
+_GENERIC_ATTRS = ('model', 'serial', 'firmware')
+_VENDOR_ATTRS = ('temperature', 'health', 'vendor_ssd_info')
+_ATTR_LOADERS = dict([(attr, '_ensure_generic') for attr in _GENERIC_ATTRS] +
+                     [(attr, '_ensure_vendor') for attr in _VENDOR_ATTRS])
+
+# Field names as printed by the utilities mapped to the attributes they populate.
+# Line based outputs are matched on these literal keys instead of running a
+# regex over the whole buffer for every field.
+_GENERIC_FIELDS = {
+    'Device Model': 'model',
+    'Serial Number': 'serial',
+    'Firmware Version': 'firmware',
+}
+
+_INNODISK_FIELDS = {
+    'Health': 'health',
+    'Temperature': 'temperature',
+}
+
 
 class SsdUtil(SsdBase):
     """
     Generic implementation of the SSD health API
     """
-    model = NOT_AVAILABLE
-    serial = NOT_AVAILABLE
-    firmware = NOT_AVAILABLE
-    temperature = NOT_AVAILABLE
-    health = NOT_AVAILABLE
-    ssd_info = NOT_AVAILABLE
-    vendor_ssd_info = NOT_AVAILABLE
-
-    def __init__(self, diskdev):
-        self.vendor_ssd_utility = {
-            "Generic"  : { "utility" : SMARTCTL, "parser" : self.parse_generic_ssd_info },
-            "InnoDisk" : { "utility" : INNODISK, "parser" : self.parse_innodisk_info },
-            "M.2"      : { "utility" : INNODISK, "parser" : self.parse_innodisk_info },
-            "StorFly"  : { "utility" : VIRTIUM,  "parser" : self.parse_virtium_info },
-            "Virtium"  : { "utility" : VIRTIUM,  "parser" : self.parse_virtium_info }
-        }
+    __slots__ = ('dev', 'model', 'serial', 'firmware', 'temperature', 'health',
+                 'ssd_info', 'vendor_ssd_info', 'vendor_hint',
+                 '_generic_done', '_vendor_done', '_lock')
+
+    def __init__(self, diskdev, vendor_hint=None):
+        """
+        Constructor
+
+        The utilities are not run here; the generic (smartctl) and vendor
+        specific information are each read on first use.
 
+        Args:
+            diskdev: Linux device name to get parameters for
+            vendor_hint: Optional vendor utility key (e.g. "InnoDisk") known to
+                         match the disk; lets the vendor utility run concurrently
+                         with smartctl instead of after the model is parsed
+        """
         self.dev = diskdev
-        # Generic part
-        self.fetch_generic_ssd_info(diskdev)
-        self.parse_generic_ssd_info()
-
-        # Known vendor part
-        if self.model:
-            model_short = self.model.split()[0]
-            if model_short in self.vendor_ssd_utility:
-                self.fetch_vendor_ssd_info(diskdev, model_short)
-                self.parse_vendor_ssd_info(model_short)
-            else:
-                # No handler registered for this disk model
+        self.vendor_hint = vendor_hint
+        with _SSD_LOCKS_GUARD:
+            self._lock = _SSD_LOCKS.get(diskdev)
+            if self._lock is None:
+                self._lock = _SSD_LOCKS[diskdev] = threading.RLock()
+        self._reset()
+
+    def refresh(self):
+        """
+        Discards the cached disk information so that it is read again on next use
+        """
+        with self._lock:
+            _SSD_CACHE.pop(self.dev, None)
+            self._reset()
+
+    def __getattr__(self, name):
+        # Only reached while a parsed attribute's slot is still unset; once the
+        # stage providing it has run, lookups go straight to the slot
+        loader = _ATTR_LOADERS.get(name)
+        if loader is None:
+            raise AttributeError(name)
+        getattr(self, loader)()
+        return object.__getattribute__(self, name)
+
+    def _reset(self):
+        for attr in _GENERIC_ATTRS + _VENDOR_ATTRS:
+            try:
+                delattr(self, attr)
+            except AttributeError:
                 pass
+        # Raw smartctl output is only kept by the fetch_generic_ssd_info hook
+        self.ssd_info = NOT_AVAILABLE
+        self._generic_done = False
+        self._vendor_done = False
+
+    def _cached_stage(self, stage):
+        cached = _SSD_CACHE.get(self.dev, {}).get(stage)
+        if cached and monotonic() - cached[0] < SSD_CACHE_TTL:
+            return cached[1]
+        return None
+
+    def _cache_stage(self, stage, values):
+        _SSD_CACHE.setdefault(self.dev, {})[stage] = (monotonic(), values)
+
+    def _ensure_generic(self):
+        if self._generic_done:
+            return
+        with self._lock:
+            if self._generic_done:
+                return
+            # Another instance for the same disk may have loaded the stage while
+            # this one waited on the lock
+            values = self._cached_stage('generic')
+            if values is None:
+                values = self._read_generic(self.dev)
+                if not values['model']:
+                    # Failed to get disk model
+                    values['model'] = "Unknown"
+                self._cache_stage('generic', values)
+            # Slots are only written once the stage has completed, so readers on
+            # other threads keep going through __getattr__ and wait on the lock
+            self._set_attrs(values)
+            self._generic_done = True
+
+    def _ensure_vendor(self):
+        if self._vendor_done:
+            return
+        with self._lock:
+            if self._vendor_done:
+                return
+            values = self._cached_stage('vendor')
+            if values is None:
+                values = self._load_vendor()
+                self._cache_stage('vendor', values)
+            self._set_attrs(values)
+            self._vendor_done = True
+
+    def _load_vendor(self):
+        values = dict.fromkeys(_VENDOR_ATTRS, NOT_AVAILABLE)
+        vendor = self.vendor_hint
+        if vendor in _VENDORS:
+            # The vendor utility only needs the disk device, so when the vendor
+            # is known up front it runs alongside smartctl rather than after it
+            fetched = {}
+
+            def fetch_vendor():
+                # Errors are handed back to this thread and raised below,
+                # the same as when the utility runs without a hint
+                try:
+                    fetched['output'] = self._read_vendor(self.dev, vendor)
+                except Exception as e:
+                    fetched['error'] = e
+
+            vendor_fetch = threading.Thread(target=fetch_vendor)
+            vendor_fetch.start()
+            try:
+                self._ensure_generic()
+            finally:
+                vendor_fetch.join()
+            if 'error' in fetched:
+                raise fetched['error']
+            values['vendor_ssd_info'] = fetched['output']
         else:
-            # Failed to get disk model
-            self.model = "Unknown"
+            self._ensure_generic()
+            vendor = self.model.split()[0]
+            if vendor in _VENDORS:
+                values['vendor_ssd_info'] = self._read_vendor(self.dev, vendor)
+            else:
+                # No handler registered for this disk model
+                vendor = None
+        if vendor:
+            values.update(self._parse_vendor(vendor, values['vendor_ssd_info']))
+        return values
+
+    def _set_attrs(self, values):
+        for attr, value in values.items():
+            setattr(self, attr, value)
+
+    def _start_process(self, argv):
+        # close_fds keeps a utility started concurrently on another thread from
+        # inheriting this one's stdout pipe and holding it open (the Python 2
+        # default is close_fds=False)
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.Popen(argv, universal_newlines=True, stdout=subprocess.PIPE, stderr=devnull,
+                                    close_fds=True)
 
-    def _execute_shell(self, cmd):
-        process = subprocess.Popen(cmd.split(), universal_newlines=True, stdout=subprocess.PIPE)
-        output, error = process.communicate()
+    def _execute_shell(self, argv):
+        output, error = self._start_process(argv).communicate()
         return output
 
-    def _parse_re(self, pattern, buffer):
-        res_list = re.findall(pattern, buffer)
-        return res_list[0] if res_list else NOT_AVAILABLE
+    def _parse_fields(self, items, fields):
+        values = {}
+        for key, value in items:
+            if key in fields and key not in values:
+                values[key] = value
+                if len(values) == len(fields):
+                    break
+        return dict((field, values.get(key, NOT_AVAILABLE)) for key, field in fields.items())
+
+    def _parse_float(self, value):
+        try:
+            return float(value)
+        except ValueError:
+            return NOT_AVAILABLE
+
+    def _colon_items(self, lines):
+        # "Device Model:     InnoDisk Corp. - mSATA 3ME"
+        # Keys must start in the first column, so only trailing whitespace is
+        # stripped from them; lines without a colon yield nothing
+        for line in lines:
+            key, sep, value = line.partition(':')
+            if sep:
+                yield key.rstrip(), value.strip()
+
+    def _innodisk_items(self, buffer):
+        for line in buffer.splitlines():
+            # "[C2]  Temperature    [   30]    [C20200646400000000000000000]"
+            if line.startswith('['):
+                line = line[line.find(']') + 1:]
+            start = line.find('[')
+            if start >= 0:
+                end = line.find(']', start)
+                if end >= 0:
+                    yield line[:start].strip(), line[start + 1:end].strip()
+            else:
+                # "Health: 82.34%"
+                key, sep, value = line.partition(':')
+                if sep:
+                    yield key.rstrip(), value.partition('%')[0].strip()
+
+    def _read_generic(self, diskdev):
+        # smartctl output is parsed as it is read rather than buffered, and
+        # smartctl is stopped as soon as every generic field has been seen
+        process = self._start_process(SMARTCTL + (diskdev,))
+        try:
+            return self._parse_fields(self._colon_items(iter(process.stdout.readline, '')), _GENERIC_FIELDS)
+        finally:
+            if process.poll() is None:
+                process.terminate()
+            process.stdout.close()
+            process.wait()
+
+    def _parse_innodisk(self, output):
+        values = self._parse_fields(self._innodisk_items(output), _INNODISK_FIELDS)
+        return dict((attr, self._parse_float(value)) for attr, value in values.items())
+
+    def _parse_virtium(self, output):
+        values = {'temperature': NOT_AVAILABLE, 'health': NOT_AVAILABLE}
+        nand_endurance = NOT_AVAILABLE
+        avg_erase_count = NOT_AVAILABLE
+        for line in output.splitlines():
+            # "194  Temperature_Celsius    0    33    100    100    0"
+            # ID, attribute name, high raw, low raw, value, worst, threshold
+            parts = line.split()
+            if len(parts) < 4:
+                continue
+            name = parts[1]
+            if name == 'Temperature_Celsius':
+                values['temperature'] = self._parse_float(parts[3])
+            elif name == 'NAND_Endurance':
+                nand_endurance = parts[3]
+            elif name == 'Average_Erase_Count':
+                avg_erase_count = parts[3]
+        try:
+            values['health'] = 100 - (float(avg_erase_count) * 100 / float(nand_endurance))
+        except (ValueError, ZeroDivisionError):
+            pass
+        return values
+
+    def _read_vendor(self, diskdev, model):
+        return self._execute_shell(_VENDORS[model][0] + (diskdev,))
+
+    def _parse_vendor(self, model, output):
+        return getattr(self, _VENDORS[model][1])(output)
+
+    # The fetch/parse hooks below keep their original signatures and set the
+    # attributes directly for platform code calling them. The lazy loading
+    # stages use the private helpers above instead, so that values are only
+    # published once a stage has completed.
 
     def fetch_generic_ssd_info(self, diskdev):
-        self.ssd_info = self._execute_shell(self.vendor_ssd_utility["Generic"]["utility"].format(diskdev))
+        self.ssd_info = self._execute_shell(SMARTCTL + (diskdev,))
 
     def parse_generic_ssd_info(self):
-        self.model = self._parse_re('Device Model:\s*(.+?)\n', self.ssd_info)
-        self.serial = self._parse_re('Serial Number:\s*(.+?)\n', self.ssd_info)
-        self.firmware = self._parse_re('Firmware Version:\s*(.+?)\n', self.ssd_info)
+        self._set_attrs(self._parse_fields(self._colon_items(self.ssd_info.splitlines()), _GENERIC_FIELDS))
 
     def parse_innodisk_info(self):
-        self.health = self._parse_re('Health:\s*(.+?)%', self.vendor_ssd_info)
-        self.temperature = self._parse_re('Temperature\s*\[\s*(.+?)\]', self.vendor_ssd_info)
+        self._set_attrs(self._parse_innodisk(self.vendor_ssd_info))
 
     def parse_virtium_info(self):
-        self.temperature = self._parse_re('Temperature_Celsius\s*\d*\s*(\d+?)\s+', self.vendor_ssd_info)
-        nand_endurance = self._parse_re('NAND_Endurance\s*\d*\s*(\d+?)\s+', self.vendor_ssd_info)
-        avg_erase_count = self._parse_re('Average_Erase_Count\s*\d*\s*(\d+?)\s+', self.vendor_ssd_info)
-        try:
-            self.health = 100 - (float(avg_erase_count) * 100 / float(nand_endurance))
-        except ValueError:
-            pass
+        self._set_attrs(self._parse_virtium(self.vendor_ssd_info))
 
     def fetch_vendor_ssd_info(self, diskdev, model):
-        self.vendor_ssd_info = self._execute_shell(self.vendor_ssd_utility[model]["utility"].format(diskdev))
+        self.vendor_ssd_info = self._read_vendor(diskdev, model)
 
     def parse_vendor_ssd_info(self, model):
-        self.vendor_ssd_utility[model]["parser"]()
+        self._set_attrs(self._parse_vendor(model, self.vendor_ssd_info))
 
     def get_health(self):
         """
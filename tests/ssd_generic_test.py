@@ -0,0 +1,414 @@
+import threading
+import time
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from sonic_platform_base.sonic_ssd import ssd_generic
+
+
+output_generic = """smartctl 6.6 2017-11-05 r4594 [x86_64-linux-4.9.0-11-2-amd64] (local build)
+Copyright (C) 2002-17, Bruce Allen, Christian Franke, www.smartmontools.org
+
+=== START OF INFORMATION SECTION ===
+Device Model:     {model}
+Serial Number:    {serial}
+Firmware Version: {firmware}
+User Capacity:    32,017,047,552 bytes [32.0 GB]
+Sector Size:      512 bytes logical/physical
+Device is:        Not in smartctl database [for details use: -P showall]
+ATA Version is:   ATA8-ACS (minor revision not indicated)
+SATA Version is:  SATA 3.0, 6.0 Gb/s (current: 6.0 Gb/s)
+SMART support is: Available - device has SMART capability.
+SMART support is: Enabled
+"""
+
+output_innodisk_generic = output_generic.format(model="InnoDisk Corp. - mSATA 3ME",
+                                                serial="20171126AAAA11730156",
+                                                firmware="S140714")
+
+output_innodisk_vendor = """********************************************************************************************
+* Innodisk iSMART V3.9.41                                                       2018/05/25 *
+********************************************************************************************
+Model Name: InnoDisk Corp. - mSATA 3ME
+FW Version: S140714
+Serial Number: 20171126AAAA11730156
+Health: 82.34%
+Capacity: 29.818199 GB
+P/E Cycle: 3000
+Lifespan : 0 (Years : 0 Months : 0 Days)
+Write Protect: Disable
+InnoRobust: Enable
+--------------------------------------------------------------------------------
+ID    SMART Attributes                            Value           Raw Value
+--------------------------------------------------------------------------------
+[09]  Power On Hours                              [32351]         [0902006464640000000000000000]
+[0C]  Power Cycle Count                           [   57]         [0C0200646439000000000000000]
+[AA]  Total Bad Block Count                       [    0]         [AA0300646400000000000000000]
+[AD]  Erase Count Max.                            [ 7395]         [AD0200646400000000000000000]
+[AD]  Erase Count Avg.                            [  530]         [AD0200646400000000000000000]
+[C2]  Temperature                                 [   30]         [C20200646400000000000000000]
+"""
+
+output_virtium_vendor = """Virtium SmartCmd Version 2.1.0
+Device: /dev/sda
+
+ ID  Attribute                        High Raw  Low Raw   Value  Worst  Threshold
+  5  Reallocated_Sector_Ct            0         0         100    100    10
+  9  Power_On_Hours                   0         4211      100    100    0
+168  NAND_Endurance                   0         20000     100    100    0
+173  Average_Erase_Count              0         174       100    100    0
+194  Temperature_Celsius              0         33        100    100    0
+"""
+
+
+class FakePopen(object):
+    """
+    Stand-in for subprocess.Popen returning canned output keyed on the utility name
+    """
+    outputs = {}
+    calls = []
+    terminated = []
+
+    def __init__(self, args, **kwargs):
+        assert kwargs.get("close_fds")
+        self.args = args
+        self.calls.append(tuple(args))
+        self.output = self.outputs.get(args[0], "")
+        self.stdout = StringIO(self.output)
+        self.returncode = None
+
+    def communicate(self):
+        self.returncode = 0
+        return self.output, None
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.terminated.append(tuple(self.args))
+        self.returncode = -15
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = 0
+        return self.returncode
+
+
+class SlowPopen(FakePopen):
+    """
+    FakePopen whose vendor utility blocks until the test releases it
+    """
+    started = None
+    release = None
+
+    def communicate(self):
+        if self.args[0] != "smartctl":
+            self.started.set()
+            self.release.wait()
+        return FakePopen.communicate(self)
+
+
+class FailingPopen(FakePopen):
+    """
+    FakePopen for a system where the vendor utility is not installed
+    """
+    def __init__(self, args, **kwargs):
+        if args[0] != "smartctl":
+            raise OSError(2, "No such file or directory")
+        FakePopen.__init__(self, args, **kwargs)
+
+
+def set_outputs(generic, vendor=""):
+    FakePopen.calls = []
+    FakePopen.terminated = []
+    FakePopen.outputs = {
+        "smartctl": generic,
+        "iSmart": vendor,
+        "SmartCmd": vendor,
+    }
+
+
+def make_ssd(generic, vendor="", vendor_hint=None):
+    set_outputs(generic, vendor)
+    ssd = ssd_generic.SsdUtil("/dev/sda", vendor_hint=vendor_hint)
+    # Information is read lazily, so load everything while Popen is replaced
+    with mock.patch.object(ssd_generic.subprocess, "Popen", FakePopen):
+        ssd.get_vendor_output()
+    return ssd
+
+
+@pytest.fixture(autouse=True)
+def clear_ssd_cache():
+    ssd_generic._SSD_CACHE.clear()
+    yield
+    ssd_generic._SSD_CACHE.clear()
+
+
+class TestSsdGeneric(object):
+
+    def test_generic_ssd(self):
+        ssd = make_ssd(output_generic.format(model="SAMSUNG MZ7LH240HAHQ-00005",
+                                             serial="S45RNA0M123456",
+                                             firmware="HXT7404Q"))
+        assert ssd.get_model() == "SAMSUNG MZ7LH240HAHQ-00005"
+        assert ssd.get_serial() == "S45RNA0M123456"
+        assert ssd.get_firmware() == "HXT7404Q"
+        assert ssd.get_health() == ssd_generic.NOT_AVAILABLE
+        assert ssd.get_temperature() == ssd_generic.NOT_AVAILABLE
+        assert ssd.get_vendor_output() == ssd_generic.NOT_AVAILABLE
+
+    def test_innodisk_ssd(self):
+        ssd = make_ssd(output_innodisk_generic,
+                       output_innodisk_vendor)
+        assert ssd.get_model() == "InnoDisk Corp. - mSATA 3ME"
+        assert ssd.get_serial() == "20171126AAAA11730156"
+        assert ssd.get_firmware() == "S140714"
+        assert ssd.get_health() == 82.34
+        assert ssd.get_temperature() == 30.0
+        assert ssd.get_vendor_output() == output_innodisk_vendor
+        assert FakePopen.calls == [ssd_generic.SMARTCTL + ("/dev/sda",),
+                                   ssd_generic.INNODISK + ("/dev/sda",)]
+
+    def test_virtium_ssd(self):
+        ssd = make_ssd(output_generic.format(model="StorFly VSFBM8CC100-VIR",
+                                             serial="60052-0090",
+                                             firmware="0202-000"),
+                       output_virtium_vendor)
+        assert ssd.get_model() == "StorFly VSFBM8CC100-VIR"
+        assert ssd.get_serial() == "60052-0090"
+        assert ssd.get_firmware() == "0202-000"
+        assert ssd.get_health() == 100 - (174.0 * 100 / 20000)
+        assert ssd.get_temperature() == 33.0
+        assert ssd.get_vendor_output() == output_virtium_vendor
+        assert FakePopen.calls == [ssd_generic.SMARTCTL + ("/dev/sda",),
+                                   ssd_generic.VIRTIUM + ("/dev/sda",)]
+
+    def test_vendor_hint_runs_utilities_concurrently(self):
+        set_outputs(output_innodisk_generic, output_innodisk_vendor)
+        SlowPopen.started = threading.Event()
+        SlowPopen.release = threading.Event()
+        ssd = ssd_generic.SsdUtil("/dev/sda", vendor_hint="InnoDisk")
+        smartctl_call = ssd_generic.SMARTCTL + ("/dev/sda",)
+        results = []
+        with mock.patch.object(ssd_generic.subprocess, "Popen", SlowPopen):
+            loader = threading.Thread(target=lambda: results.append(ssd.get_health()))
+            loader.daemon = True
+            loader.start()
+            try:
+                assert SlowPopen.started.wait(5)
+
+                # smartctl has to run while iSmart is still blocked
+                deadline = time.time() + 5
+                while smartctl_call not in FakePopen.calls and time.time() < deadline:
+                    time.sleep(0.01)
+                assert smartctl_call in FakePopen.calls
+            finally:
+                SlowPopen.release.set()
+            loader.join(5)
+        assert results == [82.34]
+        assert ssd.get_model() == "InnoDisk Corp. - mSATA 3ME"
+        assert ssd.get_temperature() == 30.0
+        assert sorted(FakePopen.calls) == sorted([smartctl_call, ssd_generic.INNODISK + ("/dev/sda",)])
+
+    def test_lazy_vendor_info(self):
+        FakePopen.calls = []
+        FakePopen.outputs = {
+            "smartctl": output_innodisk_generic,
+            "iSmart": output_innodisk_vendor,
+        }
+        with mock.patch.object(ssd_generic.subprocess, "Popen", FakePopen):
+            ssd = ssd_generic.SsdUtil("/dev/sda")
+            assert FakePopen.calls == []
+            assert ssd.get_model() == "InnoDisk Corp. - mSATA 3ME"
+            assert FakePopen.calls == [ssd_generic.SMARTCTL + ("/dev/sda",)]
+            assert ssd.temperature == 30.0
+            assert ssd.get_health() == 82.34
+        assert FakePopen.calls == [ssd_generic.SMARTCTL + ("/dev/sda",),
+                                   ssd_generic.INNODISK + ("/dev/sda",)]
+
+    def test_concurrent_reader_waits_for_load(self):
+        set_outputs(output_innodisk_generic,
+                    output_innodisk_vendor)
+        SlowPopen.started = threading.Event()
+        SlowPopen.release = threading.Event()
+        ssd = ssd_generic.SsdUtil("/dev/sda")
+        results = []
+        with mock.patch.object(ssd_generic.subprocess, "Popen", SlowPopen):
+            loader = threading.Thread(target=lambda: results.append(ssd.get_health()))
+            loader.daemon = True
+            loader.start()
+            try:
+                assert SlowPopen.started.wait(5)
+
+                # A second reader must wait for the load in progress instead of
+                # seeing a placeholder value
+                reader = threading.Thread(target=lambda: results.append(ssd.get_temperature()))
+                reader.daemon = True
+                reader.start()
+                reader.join(0.2)
+                assert reader.is_alive()
+                assert results == []
+            finally:
+                SlowPopen.release.set()
+            loader.join(5)
+            reader.join(5)
+        assert sorted(results) == [30.0, 82.34]
+
+    def test_instances_share_a_load(self):
+        set_outputs(output_innodisk_generic,
+                    output_innodisk_vendor)
+        SlowPopen.started = threading.Event()
+        SlowPopen.release = threading.Event()
+        first = ssd_generic.SsdUtil("/dev/sda")
+        second = ssd_generic.SsdUtil("/dev/sda")
+        results = []
+        with mock.patch.object(ssd_generic.subprocess, "Popen", SlowPopen):
+            loader = threading.Thread(target=lambda: results.append(first.get_health()))
+            loader.daemon = True
+            loader.start()
+            try:
+                assert SlowPopen.started.wait(5)
+
+                # A second instance for the same disk waits for the load in
+                # progress and is then served from the cache
+                reader = threading.Thread(target=lambda: results.append(second.get_health()))
+                reader.daemon = True
+                reader.start()
+                reader.join(0.2)
+                assert reader.is_alive()
+            finally:
+                SlowPopen.release.set()
+            loader.join(5)
+            reader.join(5)
+            assert second.get_model() == "InnoDisk Corp. - mSATA 3ME"
+        assert results == [82.34, 82.34]
+        assert FakePopen.calls == [ssd_generic.SMARTCTL + ("/dev/sda",),
+                                   ssd_generic.INNODISK + ("/dev/sda",)]
+
+    @pytest.mark.parametrize("vendor_hint", [None, "InnoDisk"])
+    def test_vendor_failure_is_retried(self, vendor_hint):
+        set_outputs(output_innodisk_generic,
+                    output_innodisk_vendor)
+        ssd = ssd_generic.SsdUtil("/dev/sda", vendor_hint=vendor_hint)
+        with mock.patch.object(ssd_generic.subprocess, "Popen", FailingPopen):
+            with pytest.raises(OSError):
+                ssd.get_health()
+            with pytest.raises(OSError):
+                ssd.get_temperature()
+        assert ssd.get_model() == "InnoDisk Corp. - mSATA 3ME"
+        assert "vendor" not in ssd_generic._SSD_CACHE["/dev/sda"]
+
+        with mock.patch.object(ssd_generic.subprocess, "Popen", FakePopen):
+            assert ssd.get_health() == 82.34
+            assert ssd.get_temperature() == 30.0
+
+    def test_public_hooks(self):
+        set_outputs(output_innodisk_generic,
+                    output_innodisk_vendor)
+        ssd = ssd_generic.SsdUtil("/dev/sda")
+        with mock.patch.object(ssd_generic.subprocess, "Popen", FakePopen):
+            ssd.fetch_generic_ssd_info("/dev/sda")
+            assert ssd.ssd_info == FakePopen.outputs["smartctl"]
+            ssd.parse_generic_ssd_info()
+            assert ssd.model == "InnoDisk Corp. - mSATA 3ME"
+            ssd.fetch_vendor_ssd_info("/dev/sda", "InnoDisk")
+        assert ssd.vendor_ssd_info == output_innodisk_vendor
+        ssd.parse_vendor_ssd_info("InnoDisk")
+        assert ssd.health == 82.34
+        assert ssd.temperature == 30.0
+
+        ssd.vendor_ssd_info = output_virtium_vendor
+        ssd.parse_virtium_info()
+        assert ssd.temperature == 33.0
+
+    def test_generic_stops_smartctl_early(self):
+        make_ssd(output_generic.format(model="SAMSUNG MZ7LH240HAHQ-00005",
+                                       serial="S45RNA0M123456",
+                                       firmware="HXT7404Q"))
+        assert FakePopen.terminated == [ssd_generic.SMARTCTL + ("/dev/sda",)]
+
+        # Without all fields present the whole output is read
+        make_ssd("")
+        assert FakePopen.terminated == []
+
+    def test_non_numeric_vendor_fields(self):
+        ssd = make_ssd(output_innodisk_generic,
+                       output_innodisk_vendor.replace("82.34%", "unknown%").replace("[   30]", "[  n/a]"))
+        assert ssd.get_health() == ssd_generic.NOT_AVAILABLE
+        assert ssd.get_temperature() == ssd_generic.NOT_AVAILABLE
+
+    def test_virtium_zero_endurance(self):
+        ssd = make_ssd(output_generic.format(model="StorFly VSFBM8CC100-VIR",
+                                             serial="60052-0090",
+                                             firmware="0202-000"),
+                       output_virtium_vendor.replace("20000", "0    "))
+        assert ssd.get_health() == ssd_generic.NOT_AVAILABLE
+        assert ssd.get_temperature() == 33.0
+
+    def test_missing_fields(self):
+        ssd = make_ssd("")
+        assert ssd.get_model() == ssd_generic.NOT_AVAILABLE
+        assert ssd.get_serial() == ssd_generic.NOT_AVAILABLE
+        assert ssd.get_firmware() == ssd_generic.NOT_AVAILABLE
+        assert ssd.get_health() == ssd_generic.NOT_AVAILABLE
+        assert ssd.get_temperature() == ssd_generic.NOT_AVAILABLE
+
+    def test_cached_info(self):
+        make_ssd(output_innodisk_generic, output_innodisk_vendor)
+        assert len(FakePopen.calls) == 2
+
+        # A new instance for the same disk is served from the cache
+        ssd = make_ssd(output_innodisk_generic, output_innodisk_vendor)
+        assert FakePopen.calls == []
+        assert ssd.get_model() == "InnoDisk Corp. - mSATA 3ME"
+        assert ssd.get_health() == 82.34
+        assert ssd.get_vendor_output() == output_innodisk_vendor
+
+        # Explicit refresh re-runs the utilities
+        FakePopen.outputs["iSmart"] = output_innodisk_vendor.replace("82.34%", "80.00%")
+        ssd.refresh()
+        with mock.patch.object(ssd_generic.subprocess, "Popen", FakePopen):
+            assert ssd.get_health() == 80.0
+        assert len(FakePopen.calls) == 2
+
+    def test_cache_expiry(self):
+        generic = output_generic.format(model="SAMSUNG MZ7LH240HAHQ-00005",
+                                        serial="S45RNA0M123456",
+                                        firmware="HXT7404Q")
+        with mock.patch.object(ssd_generic, "monotonic", return_value=1000):
+            make_ssd(generic)
+        with mock.patch.object(ssd_generic, "monotonic", return_value=1000 + ssd_generic.SSD_CACHE_TTL - 1):
+            make_ssd(generic)
+        assert FakePopen.calls == []
+        with mock.patch.object(ssd_generic, "monotonic", return_value=1000 + ssd_generic.SSD_CACHE_TTL):
+            make_ssd(generic)
+        assert len(FakePopen.calls) == 1
+
+    def test_cache_expiry_per_stage(self):
+        set_outputs(output_innodisk_generic, output_innodisk_vendor)
+        with mock.patch.object(ssd_generic.subprocess, "Popen", FakePopen):
+            ssd = ssd_generic.SsdUtil("/dev/sda")
+            with mock.patch.object(ssd_generic, "monotonic", return_value=1000):
+                ssd.get_model()
+            with mock.patch.object(ssd_generic, "monotonic", return_value=1050):
+                ssd.get_health()
+            assert len(FakePopen.calls) == 2
+
+            # The generic stage expires on its own timestamp, not on the later
+            # vendor one, while the vendor stage is still served from the cache
+            FakePopen.calls = []
+            with mock.patch.object(ssd_generic, "monotonic", return_value=1000 + ssd_generic.SSD_CACHE_TTL):
+                ssd = ssd_generic.SsdUtil("/dev/sda")
+                assert ssd.get_model() == "InnoDisk Corp. - mSATA 3ME"
+                assert ssd.get_health() == 82.34
+        assert FakePopen.calls == [ssd_generic.SMARTCTL + ("/dev/sda",)]